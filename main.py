@@ -1,14 +1,22 @@
 import asyncio
 from datetime import datetime
-import json
+import functools
+import io
 import os
 import secrets
+import sys
 import traceback
-from typing import List, Optional
-import aiofiles
+from typing import Dict, List, Optional, Sequence, Set
 import discord
+import orjson
 from discord.ext import slash
 from discord.ext import commands
+try:
+    import uvloop
+except ImportError:
+    pass # the default event loop works too, just slower
+else:
+    uvloop.install()
 
 CONFIG_FILE = 'convosplit.json'
 
@@ -43,14 +51,18 @@ Those in {author.mention}'s conversation \
 please move to {channel.mention} (convo {key}).
 """.strip()
 CONVO_DONE = 'Conversation {key} finished:'
+CONVO_EMPTY = 'Conversation {key} finished with no messages.'
 PERMS_WARNING = """
 \N{WARNING SIGN} **Warning**: I cannot send messages with a file as a bot \
 in this channel or the `dest_channel` (if specified). If the conversation \
 (including ending inactivity, if any) lasts more than 10 minutes, its log \
 will be lost!
 """.strip()
-FILENAME_FMT = '{name}---{start:%Y-%m-%d %H-%M-%S}---{end:%Y-%m-%d %H-%M-%S}.txt'
+TIMESTAMP_FMT = '%Y-%m-%d %H-%M-%S'
 SEPARATOR = '--New Message Starts After Two Line Feeds After This Line'
+MESSAGE_START = (SEPARATOR + '\n').encode('utf8')
+ARCHIVE_END = (SEPARATOR + '--\n').encode('utf8')
+FORMAT_BATCH_SIZE = 50
 
 MY_PERMS = discord.PermissionOverwrite(
     read_messages=True, read_message_history=True, send_messages=True,
@@ -59,8 +71,8 @@ MY_PERMS = discord.PermissionOverwrite(
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
-with open(CONFIG_FILE) as f:
-    CONFIG = json.load(f)
+with open(CONFIG_FILE, 'rb') as f:
+    CONFIG = orjson.loads(f.read())
 
 client = slash.SlashBot(
     description=BOT_DESC,
@@ -73,6 +85,9 @@ client = slash.SlashBot(
     fetch_if_not_get=True
 )
 
+def json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
 async def send_error(method, msg):
     await method(ERROR_FMT + msg)
 
@@ -107,16 +122,70 @@ async def on_command_error(ctx, exc):
         sep='\n', flush=True
     )
 
+@functools.lru_cache(maxsize=1024)
+def is_convosplit_name(name: str) -> bool:
+    return 'convosplit' in name.casefold()
+
 def cat_check(cat: discord.CategoryChannel):
-    return 'convosplit' in cat.name.casefold()
+    return is_convosplit_name(cat.name)
+
+# guild ID => ConvoSplit category in that guild
+CATEGORIES: Dict[int, discord.CategoryChannel] = {}
+
+@client.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    """Forget a cached category when it is deleted."""
+    cat = CATEGORIES.get(channel.guild.id)
+    if cat and cat.id == channel.id:
+        del CATEGORIES[channel.guild.id]
+
+@client.event
+async def on_guild_channel_update(
+    before: discord.abc.GuildChannel,
+    after: discord.abc.GuildChannel
+):
+    """Forget a cached category when it is renamed."""
+    if before.name == after.name:
+        return
+    cat = CATEGORIES.get(after.guild.id)
+    if cat and cat.id == after.id:
+        del CATEGORIES[after.guild.id]
+
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+    """Forget the cached category of a guild I left."""
+    CATEGORIES.pop(guild.id, None)
+
+async def find_category(
+    guild: discord.Guild
+) -> Optional[discord.CategoryChannel]:
+    """Find the ConvoSplit category, only fetching if not cached."""
+    cat = CATEGORIES.get(guild.id) \
+        or discord.utils.find(cat_check, guild.categories)
+    if not cat:
+        # the gateway cache might be stale, so ask the API as a last resort
+        cat = discord.utils.find(
+            lambda c: isinstance(c, discord.CategoryChannel) and cat_check(c),
+            await guild.fetch_channels())
+    if cat:
+        CATEGORIES[guild.id] = cat
+    return cat
+
+def deny_send(
+    overws: discord.PermissionOverwrite
+) -> discord.PermissionOverwrite:
+    """Copy the overwrite, but with sending messages denied."""
+    allow, deny = overws.pair()
+    deny.send_messages = True
+    allow.send_messages = False
+    return discord.PermissionOverwrite.from_pair(allow, deny)
 
 async def create_channel(
     ctx: slash.Context,
-    members: List[discord.Member]
+    members: Sequence[discord.Member]
 ) -> Optional[discord.TextChannel]:
     """Create a new temporary channel."""
-    cat: discord.CategoryChannel = discord.utils.find(
-        cat_check, await ctx.guild.fetch_channels())
+    cat = await find_category(ctx.guild)
     if not cat:
         await send_error(ctx.respond, NO_CAT_ERROR)
         return None
@@ -132,10 +201,13 @@ async def create_channel(
         # in case the originating channel allows more than just these
         # people to send messages, explicitly disallow sending messages
         # for everyone else
-        for user_or_role, overws in overwrites.items():
-            if user_or_role is ctx.me:
-                continue # don't deny myself lol
-            overws.send_messages = False
+        overwrites = {
+            user_or_role: (
+                overws if user_or_role is ctx.me # don't deny myself lol
+                else deny_send(overws)
+            )
+            for user_or_role, overws in overwrites.items()
+        }
         # explicitly allow sending messages for the actual members
         for member in members:
             overwrites[member] = discord.PermissionOverwrite(
@@ -146,8 +218,8 @@ async def create_channel(
     # create and return the channel with its name and permissions
     try:
         channel = await cat.create_text_channel(
-            new_channel_name, reason=NEW_CHANNEL_REASON)
-        await channel.edit(overwrites=overwrites, reason=NEW_CHANNEL_REASON)
+            new_channel_name, overwrites=overwrites,
+            reason=NEW_CHANNEL_REASON)
     except discord.Forbidden:
         await send_error(ctx.respond, NO_PERMS_ERROR)
         return None
@@ -157,7 +229,7 @@ async def notify_members(
     ctx: slash.Context,
     channel: discord.TextChannel,
     dest: discord.TextChannel,
-    members: List[discord.Member]
+    members: Sequence[discord.Member]
 ):
     """Complete the response and notify members if necessary."""
     key = channel.name.split('-')[-1]
@@ -170,100 +242,182 @@ async def notify_members(
     p1 = (p1.send_messages and p1.read_messages and p1.attach_files)
     p2 = dest.permissions_for(ctx.me)
     p2 = (p2.send_messages and p2.read_messages and p2.attach_files)
+    # send the warning and mentions together to save a request
+    tail = []
     if not (p2 or p1):
-        await ctx.webhook.send(PERMS_WARNING)
+        tail.append(PERMS_WARNING)
     if members:
-        await ctx.webhook.send(' '.join(m.mention for m in members))
+        tail.append(' '.join(m.mention for m in members))
+    if tail:
+        await ctx.webhook.send('\n'.join(tail))
 
 def is_goodbye(content: str) -> bool:
-    content = content.lstrip().casefold()
+    # only the start matters, so don't casefold the whole message
+    content = content.lstrip()[:16].casefold()
     return content.startswith('goodbye')
 
+# channel ID => queue of messages sent in that ongoing conversation
+CONVO_QUEUES: Dict[int, asyncio.Queue] = {}
+
+@client.listen()
+async def on_message(msg: discord.Message):
+    """Route messages to the conversation in their channel, if any."""
+    queue = CONVO_QUEUES.get(msg.channel.id)
+    if queue is not None:
+        queue.put_nowait(msg)
+
+# channel ID => IDs of messages deleted during that conversation
+DELETED_MESSAGES: Dict[int, Set[int]] = {}
+
+@client.listen()
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    """Note deleted messages so they are left out of the archive."""
+    deleted = DELETED_MESSAGES.get(payload.channel_id)
+    if deleted is not None:
+        deleted.add(payload.message_id)
+
+@client.listen()
+async def on_raw_bulk_message_delete(
+    payload: discord.RawBulkMessageDeleteEvent
+):
+    """Note deleted messages so they are left out of the archive."""
+    deleted = DELETED_MESSAGES.get(payload.channel_id)
+    if deleted is not None:
+        deleted.update(payload.message_ids)
+
 async def await_end(
     channel: discord.TextChannel,
     timeout: int
 ) -> List[discord.Message]:
-    """Wait for the conversation to end, by timeout or /exit."""
+    """Wait for the conversation to end, by timeout or /exit.
+
+    Return the messages sent in the meantime. Edits and reactions only
+    show up in them while they are still in the client's message cache,
+    so in very busy bots older messages may be archived as first seen.
+    Messages sent after the goodbye stay queued until drain_queue
+    collects them once the channel is locked.
+    """
+    msgs = []
+    queue = CONVO_QUEUES[channel.id]
     while 1:
         try:
-            msg = await client.wait_for(
-                'message', check=lambda m: m.channel.id == channel.id,
-                timeout=timeout * 60)
+            msg = await asyncio.wait_for(queue.get(), timeout * 60)
         except asyncio.TimeoutError:
             await channel.send('Goodbye.')
-            return
+            return msgs
         if msg.author.id == client.user.id and is_goodbye(msg.content):
-            return
+            return msgs
+        msgs.append(msg)
+
+def drain_queue(
+    channel: discord.TextChannel,
+    msgs: List[discord.Message]
+):
+    """Add messages still queued after the goodbye to msgs."""
+    queue = CONVO_QUEUES[channel.id]
+    while not queue.empty():
+        msg = queue.get_nowait()
+        if msg.author.id == client.user.id and is_goodbye(msg.content):
+            continue
+        msgs.append(msg)
+
+async def collect_users(r: discord.Reaction) -> List[str]:
+    """Format every user who reacted with a reaction."""
+    return [f'{user!s} ({user.id})' async for user in r.users()]
 
 async def format_message(msg: discord.Message) -> str:
     """Format a message into multipart-like format."""
-    lines = []
-    lines.append(f'Message-Id: {msg.id}')
-    lines.append(f'Author: {msg.author!s} ({msg.author.id})')
-    lines.append(f'Sent: {msg.created_at.isoformat()}')
+    buf = io.StringIO()
+    w = buf.write
+    w(f'Message-Id: {msg.id}\n')
+    w(f'Author: {msg.author!s} ({msg.author.id})\n')
+    w(f'Sent: {msg.created_at.isoformat()}\n')
     if msg.edited_at:
-        lines.append(f'Edited: {msg.edited_at.isoformat()}')
+        w(f'Edited: {msg.edited_at.isoformat()}\n')
     if msg.reference:
         if msg.type == discord.MessageType.pins_add:
-            lines.append(f'Pins: {msg.reference.message_id}')
+            w(f'Pins: {msg.reference.message_id}\n')
         else:
-            lines.append(f'Reply-To: {msg.reference.message_id}')
-    for r in msg.reactions:
-        users = []
-        async for user in r.users():
-            users.append(f'{user!s} ({user.id})')
-        lines.append(f'Reaction: {r!s}; {", ".join(users)}')
+            w(f'Reply-To: {msg.reference.message_id}\n')
+    reaction_users = await asyncio.gather(*map(collect_users, msg.reactions))
+    for r, users in zip(msg.reactions, reaction_users):
+        w(f'Reaction: {r!s}; {", ".join(users)}\n')
     for f in msg.attachments:
-        lines.append('Attachment: name={}, content_type={}, url={}'.format(
+        w('Attachment: name={}, content_type={}, url={}\n'.format(
             f.filename, f.content_type or 'Unspecified', f.url
         ))
     for e in msg.embeds:
-        lines.append(f'Embed: {json.dumps(e.to_dict())}')
-    lines.append('')
+        w(f'Embed: {json_dumps(e.to_dict())}\n')
+    w('\n')
     if msg.is_system():
-        lines.append(msg.system_content)
+        w(msg.system_content)
     else:
-        lines.append(msg.content)
-    return '\n'.join(lines)
+        w(msg.content)
+    return buf.getvalue()
+
+async def format_batch(batch: List[discord.Message]) -> List[bytes]:
+    """Format a batch of messages concurrently, preserving order."""
+    formatted = await asyncio.gather(*map(format_message, batch))
+    return [MESSAGE_START + text.encode('utf8') + b'\n' for text in formatted]
+
+def write_file(filename: str, data: bytes):
+    with open(filename, 'wb') as dump:
+        dump.write(data)
+
+def read_file(filename: str) -> bytes:
+    with open(filename, 'rb') as dump:
+        return dump.read()
+
+def archive_file(data: Optional[bytes], filename: Optional[str]):
+    """Build an attachment for the archive, if there is one."""
+    if not filename:
+        return None
+    return discord.File(io.BytesIO(data), filename=os.path.basename(filename))
 
 async def save_messages(
     start: datetime,
-    channel: discord.TextChannel
-) -> str:
-    """Save messages to a file. Return its name."""
-    filename = os.path.join('convos', FILENAME_FMT.format(
-        name=channel.name,
-        start=start,
-        end=datetime.utcnow()
-    ))
-    async with aiofiles.open(filename, 'w', encoding='utf8') as dump:
-        async for msg in channel.history(oldest_first=True):
-            if msg.author.id == client.user.id and is_goodbye(msg.content):
-                continue
-            await dump.write(SEPARATOR + '\n'
-                             + (await format_message(msg)) + '\n')
-        await dump.write(SEPARATOR + '--\n')
+    channel: discord.TextChannel,
+    msgs: List[discord.Message]
+) -> Optional[str]:
+    """Save messages to a file. Return its name, or None if no messages."""
+    if not msgs:
+        return None
+    s = start.strftime(TIMESTAMP_FMT)
+    e = datetime.utcnow().strftime(TIMESTAMP_FMT)
+    filename = os.path.join('convos', f'{channel.name}---{s}---{e}.txt')
+    chunks = []
+    for i in range(0, len(msgs), FORMAT_BATCH_SIZE):
+        chunks.extend(await format_batch(msgs[i:i + FORMAT_BATCH_SIZE]))
+    chunks.append(ARCHIVE_END)
+    await asyncio.to_thread(write_file, filename, b''.join(chunks))
     return filename
 
 async def conclude(
     ctx: slash.Context,
     start: datetime,
     channel: discord.TextChannel,
-    filename: str,
+    filename: Optional[str],
     dest: Optional[discord.TextChannel]
 ):
-    """Delete the channel and send its archive."""
+    """Delete the channel and send its archive, if any."""
     await channel.delete(reason=DELETE_REASON)
-    content = CONVO_DONE.format(key=channel.name.split('-')[-1])
-    attachment = discord.File(filename)
+    key = channel.name.split('-')[-1]
+    if filename:
+        content = CONVO_DONE.format(key=key)
+        data = await asyncio.to_thread(read_file, filename)
+    else:
+        content = CONVO_EMPTY.format(key=key)
+        data = None
+    attachment = archive_file(data, filename)
     if dest:
         try:
             await dest.send(content, file=attachment)
         except discord.Forbidden:
             # failing to send can still close the file
-            attachment = discord.File(filename)
+            attachment = archive_file(data, filename)
         else:
-            os.unlink(filename)
+            if filename:
+                os.unlink(filename)
             return
     if (datetime.utcnow() - start).seconds < (10 * 60):
         await ctx.webhook.send(content, file=attachment)
@@ -272,7 +426,8 @@ async def conclude(
             await ctx.send(content, file=attachment)
         except discord.Forbidden:
             pass # welp, we warned them and we tried
-    os.unlink(filename)
+    if filename:
+        os.unlink(filename)
 
 memberopts = [slash.Option(
     description=MEMBER_DESC % (i + 1),
@@ -293,24 +448,36 @@ async def split(
     dest_channel: channelopt = None
 ):
     """Split the conversation into a new temporary channel."""
-    members = [m for m in [member1, member2, member3, member4, member5] if m]
+    members = tuple(filter(None, (
+        member1, member2, member3, member4, member5)))
     await ctx.respond(deferred=True)
     channel = await create_channel(ctx, members)
     if not channel:
         return
-    await notify_members(ctx, channel, dest_channel or ctx.channel, members)
-    start = datetime.utcnow()
-    await await_end(channel, timeout)
-    # lock the channel
-    await channel.edit(
-        overwrites={
-            ctx.guild.default_role: discord.PermissionOverwrite(
-                read_messages=False, send_messages=False),
-            ctx.me: MY_PERMS
-        },
-        reason=LOCK_REASON
-    )
-    filename = await save_messages(start, channel)
+    # start listening right away so that nobody who moves
+    # to the channel while we're still responding is missed
+    CONVO_QUEUES[channel.id] = asyncio.Queue()
+    deleted = DELETED_MESSAGES[channel.id] = set()
+    try:
+        await notify_members(
+            ctx, channel, dest_channel or ctx.channel, members)
+        start = datetime.utcnow()
+        msgs = await await_end(channel, timeout)
+        # lock the channel
+        await channel.edit(
+            overwrites={
+                ctx.guild.default_role: discord.PermissionOverwrite(
+                    read_messages=False, send_messages=False),
+                ctx.me: MY_PERMS
+            },
+            reason=LOCK_REASON
+        )
+        drain_queue(channel, msgs)
+        msgs = [msg for msg in msgs if msg.id not in deleted]
+    finally:
+        del CONVO_QUEUES[channel.id]
+        del DELETED_MESSAGES[channel.id]
+    filename = await save_messages(start, channel, msgs)
     await conclude(ctx, start, channel, filename, dest_channel)
 
 @client.slash_cmd()
@@ -332,7 +499,10 @@ async def wakeup():
             return
 
 try:
-    client.loop.create_task(wakeup())
+    # client.run already handles SIGINT on POSIX, but Windows has no
+    # signal handlers, so wake up regularly to let KeyboardInterrupt through
+    if sys.platform == 'win32':
+        client.loop.create_task(wakeup())
     client.run(CONFIG['token'])
 finally:
     print('Goodbye.')